@@ -15,16 +15,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from __future__ import print_function
+import logging
+import sys
 
 from st2common.runners.base_action import Action
 
+from lib.packagecloud import LOG as PACKAGECLOUD_LOG
+from lib.packagecloud import close_session
 from lib.packagecloud import create_master_token
 from lib.packagecloud import destroy_master_token
 from lib.packagecloud import create_read_token
 from lib.packagecloud import destroy_read_token
+from lib.packagecloud import destroy_read_tokens_matching
 from lib.packagecloud import get_master_token
 from lib.packagecloud import get_master_tokens
+from lib.packagecloud import set_api_token
 
 
 class ActionManager(Action):
@@ -40,10 +45,8 @@ class ActionManager(Action):
         api_version = "v1"
 
         conf = {
-            "domain_base": "{}://{}:@{}".format(http_scheme, api_token, api_domain),
-            "url_base": "{}://{}:@{}/api/{}".format(
-                http_scheme, api_token, api_domain, api_version
-            ),
+            "domain_base": f"{http_scheme}://{api_domain}",
+            "url_base": f"{http_scheme}://{api_domain}/api/{api_version}",
             "user": kwargs.pop("user"),
             "repo": kwargs.pop("repository"),
             "verbose": not kwargs.get("concise", False),
@@ -51,18 +54,39 @@ class ActionManager(Action):
             "token_name": kwargs.get("token_name"),
             "read_token_name": kwargs.get("read_token_name"),
             "master_token_name": kwargs.get("master_token_name"),
+            "read_token_pattern": kwargs.get("read_token_pattern"),
         }
+        conf["repo_base"] = f"{conf['url_base']}/repos/{conf['user']}/{conf['repo']}"
 
         funcs = {
             "create_master_token": create_master_token,
             "destroy_master_token": destroy_master_token,
             "create_read_token": create_read_token,
             "destroy_read_token": destroy_read_token,
+            "destroy_read_tokens_matching": destroy_read_tokens_matching,
             "get_master_token": get_master_token,
             "list_master_token": get_master_tokens,
         }
 
         function = kwargs.pop("function")
 
+        set_api_token(api_token)
+
+        # Debug output goes to stdout only, and only for this run.
+        handler = None
+        if conf["debug"]:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter("DEBUG: %(message)s"))
+            PACKAGECLOUD_LOG.addHandler(handler)
+            PACKAGECLOUD_LOG.setLevel(logging.DEBUG)
+            PACKAGECLOUD_LOG.propagate = False
+
         # Call the function
-        funcs[function](conf, conf["verbose"])
+        try:
+            funcs[function](conf, conf["verbose"])
+        finally:
+            if handler is not None:
+                PACKAGECLOUD_LOG.removeHandler(handler)
+                PACKAGECLOUD_LOG.setLevel(logging.NOTSET)
+                PACKAGECLOUD_LOG.propagate = True
+            close_session()
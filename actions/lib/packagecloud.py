@@ -12,68 +12,226 @@ https://github.com/denisbr/python-packagecloud
 """
 
 
-from __future__ import print_function
-
+import logging
+import random
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from urllib.parse import urlencode
 
-from requests import ConnectionError
 from requests.exceptions import RequestException
 from requests import HTTPError
 from requests import Request
 from requests import Session
-from requests import Timeout
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+LOG = logging.getLogger(__name__)
+
+# POST bodies are encoded up front, so requests sends them as they are.
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
 
+# Connect and read timeouts, in seconds, for every API call.
+TIMEOUT = (5, 30)
+
+# Number of API calls allowed in flight at once.
+MAX_WORKERS = 8
+
+
+class JitteredRetry(Retry):
+    """Retry with capped exponential backoff and jitter
+
+    urllib3's own backoff does not wait before the first retry and adds no
+    jitter before 2.0, so concurrent calls failing together would retry in
+    lockstep.  Here retry n waits min(BACKOFF_CAP, backoff_factor * 2**(n-1))
+    scaled by a random factor between 0.5 and 1.5.
+    """
 
-def eprint(*args, **kwargs):
-    """Print to stderr"""
-    print(*args, file=sys.stderr, **kwargs)
+    BACKOFF_CAP = 8.0
+
+    def get_backoff_time(self):
+        retries = len(self.history)
+        if retries == 0:
+            return 0
+        backoff = min(self.BACKOFF_CAP, self.backoff_factor * (2 ** (retries - 1)))
+        return backoff * random.uniform(0.5, 1.5)
+
+
+# Three attempts in all, backing off about 0.25s then 0.5s between them, or
+# as long as Retry-After asks on 429.  Only timeouts, rate limiting and
+# server errors are retried; other 4xx responses fail on the first attempt.
+# The final response is handed back rather than raised so api_call can
+# report it.
+_RETRY = JitteredRetry(
+    total=2,
+    backoff_factor=0.25,
+    status_forcelist=frozenset([408, 429]) | frozenset(range(500, 600)),
+    allowed_methods=frozenset(["GET", "POST", "DELETE"]),
+    raise_on_status=False,
+)
+
+# A single session is shared by all API calls so the TLS connection to
+# packagecloud.io is kept alive and reused between requests.  All calls go
+# to one host, so one pool is enough; it holds a connection per worker so
+# concurrent calls are not serialised, and blocks rather than opening
+# extra connections that would be discarded afterwards.
+SESSION = Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, pool_block=True, max_retries=_RETRY),
+)
+# Ask for compressed JSON; _json() decodes the already inflated bytes.
+SESSION.headers.update(
+    {
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    }
+)
 
 
 def abort(errstr, errcode=1):
     """Print error and exit with errcode"""
-    eprint(errstr)
+    print(errstr, file=sys.stderr)
     sys.exit(errcode)
 
 
-def api_call(url, method, debug, **kwargs):
+def _json(resp):
+    """Decode a JSON response body
+
+    Raises ValueError if the body is not valid JSON.
+    """
+    return json_loads(resp.content)
+
+
+def set_api_token(api_token):
+    """Authenticate all API calls on the shared session with api_token
+
+    The token is sent as the HTTP Basic auth username with an empty
+    password, which keeps it out of request URLs.
+    """
+    SESSION.auth = (api_token, "")
+
+
+def close_session():
+    """Close the shared HTTP session and its pooled connections"""
+    SESSION.close()
+
+
+def run_concurrently(func, items):
+    """Call func once per item on a thread pool
+
+    Results are yielded in the same order as items, and released once
+    yielded.  Exceptions raised by func, including SystemExit from abort(),
+    propagate to the caller.
+    """
+    items = list(items)
+    if len(items) < 2:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        yield from executor.map(func, items)
+
+
+def api_call(url, method, **kwargs):
     """Generic method to make HTTP requests to the packagecloud API
 
-    Will retry on connection error or timeout, until max retries
+    Connection errors, timeouts and transient server errors are retried
+    by the session's adapter with exponential backoff, until max retries
     """
-    resp = None
-    attempt = 0
-    maxattempts = 3
     req = Request(method.upper(), url, **kwargs)
+    prepped = SESSION.prepare_request(req)
 
-    if debug:
-        print("DEBUG: Request ({}) {}".format(method.upper(), url))
+    LOG.debug("Request (%s) %s", method.upper(), url)
 
-    while True:
-        try:
-            attempt += 1
-            resp = Session().send(Session().prepare_request(req), verify=True)
-            resp.raise_for_status()
-            break
-        except (HTTPError, ConnectionError, Timeout) as ex:
-            if attempt >= maxattempts:
-                abort(ex.response)
-            else:
-                time.sleep(1)
-                continue
-        except RequestException as ex:
-            abort(ex.response)
-
-    if resp is not None:
-        return resp
-    else:
-        abort("Error making API call to URL: " % url)
+    try:
+        resp = SESSION.send(prepped, timeout=TIMEOUT)
+        resp.raise_for_status()
+    except HTTPError as ex:
+        abort(ex.response)
+    except RequestException as ex:
+        abort(ex)
+
+    return resp
 
 
 ###########################################################
 # Packagecloud Master tokens                              #
 # https://packagecloud.io/docs/api#resource_master_tokens #
 ###########################################################
+
+# Seconds a master token listing is reused for, should the library be used
+# from a long lived process.
+MASTER_TOKEN_TTL = 30
+
+# Master tokens listed so far, the same tokens indexed by name, and when the
+# listing goes stale, all keyed by _master_token_key().
+_master_token_cache = {}
+_master_token_index = {}
+_master_token_expiry = {}
+
+
+def index_by_name(tokens):
+    """Map token names to tokens, keeping the first token of each name"""
+    index = {}
+    for token in tokens:
+        index.setdefault(token["name"], token)
+    return index
+
+
+def _master_token_key(config):
+    """Cache key for the master tokens of the configured repository
+
+    The session's credentials are part of the key, so a listing fetched
+    with one API token is never handed out to a call made with another.
+    """
+    return (SESSION.auth, config["url_base"], config["user"], config["repo"])
+
+
+def _load_master_tokens(config):
+    """List master tokens in repository, reusing an earlier listing
+
+    GET /api/v1/repos/:user/:repo/master_tokens
+    """
+    key = _master_token_key(config)
+    if _master_token_expiry.get(key, 0) <= time.monotonic():
+        url = f"{config['repo_base']}/master_tokens"
+
+        try:
+            resp = api_call(url, "get")
+            _master_token_cache[key] = _json(resp)
+            _master_token_index[key] = index_by_name(_master_token_cache[key])
+            _master_token_expiry[key] = time.monotonic() + MASTER_TOKEN_TTL
+        except ValueError as ex:
+            abort(f"Unexpected response from packagecloud API: {ex}")
+
+    return _master_token_cache[key]
+
+
+def _invalidate_master_tokens(config):
+    """Forget the master token listing after the repository changed"""
+    key = _master_token_key(config)
+    _master_token_cache.pop(key, None)
+    _master_token_index.pop(key, None)
+    _master_token_expiry.pop(key, None)
+
+
+def _add_master_token(config, token):
+    """Record a newly created master token in the cached listing"""
+    key = _master_token_key(config)
+    if key in _master_token_cache:
+        _master_token_cache[key].append(token)
+        _master_token_index[key].setdefault(token["name"], token)
+
+
 def get_master_tokens(config, verbose):
     """Lists all master tokens in repository
 
@@ -81,24 +239,15 @@ def get_master_tokens(config, verbose):
 
     GET /api/v1/repos/:user/:repo/master_tokens
     """
-    url = "{}/repos/{}/{}/master_tokens".format(config["url_base"], config["user"], config["repo"])
-
-    try:
-        resp = api_call(url, "get", config["debug"])
-        tokens = resp.json()
-    except ValueError as ex:
-        abort("Unexpected response from packagecloud API: " "{}".format(str(ex)))
+    tokens = _load_master_tokens(config)
 
     if verbose:
-        print("Tokens for %s/%s:" % (config["user"], config["repo"]))
+        print(f"Tokens for {config['user']}/{config['repo']}:")
         for obj in tokens:
-            print("\n  %s (%s)" % (obj["name"], obj["value"]))
+            print(f"\n  {obj['name']} ({obj['value']})")
             print("  read tokens:")
             for robj in obj["read_tokens"]:
-                print(
-                    "    { id: %s, name: %s, value: %s }"
-                    % (robj["id"], robj["name"], robj["value"])
-                )
+                print(f"    {{ id: {robj['id']}, name: {robj['name']}, value: {robj['value']} }}")
 
     return tokens
 
@@ -110,18 +259,12 @@ def get_master_token(config, verbose):
 
     GET /api/v1/repos/:user/:repo/master_tokens
     """
-    url = "{}/repos/{}/{}/master_tokens".format(config["url_base"], config["user"], config["repo"])
-
-    try:
-        resp = api_call(url, "get", config["debug"])
-        tokens = resp.json()
-    except ValueError as ex:
-        abort("Unexpected response from packagecloud API: " "{}".format(str(ex)))
-    for token in tokens:
-        if token["name"] == config["token_name"]:
-            if verbose:
-                print(token["value"], end="")
-            return token
+    _load_master_tokens(config)
+    token = _master_token_index[_master_token_key(config)].get(config["token_name"])
+    if token is not None:
+        if verbose:
+            print(token["value"], end="")
+        return token
 
     print("No master token found!", end="")
     return None
@@ -134,19 +277,20 @@ def create_master_token(config, verbose):
 
     POST /api/v1/repos/:user/:repo/master_tokens
     """
-    url = "{}/repos/{}/{}/master_tokens".format(config["url_base"], config["user"], config["repo"])
-    postdata = "master_token[name]={}".format(config["token_name"])
+    url = f"{config['repo_base']}/master_tokens"
+    postdata = urlencode({"master_token[name]": config["token_name"]}).encode("ascii")
 
     try:
-        resp = api_call(url, "post", config["debug"], data=postdata)
-        token = resp.json()
+        resp = api_call(url, "post", data=postdata, headers=FORM_HEADERS)
+        token = _json(resp)
     except ValueError as ex:
-        abort("Unexpected response from packagecloud API: " "{}".format(str(ex)))
+        abort(f"Unexpected response from packagecloud API: {ex}")
+    _add_master_token(config, token)
 
     if verbose:
-        print("Master token {} with value {} created".format(token["name"], token["value"]), end="")
+        print(f"Master token {token['name']} with value {token['value']} created", end="")
     else:
-        print("{}".format(token["value"]), end="")
+        print(token["value"], end="")
 
     return token
 
@@ -158,25 +302,23 @@ def destroy_master_token(config, verbose):
 
     DELETE /api/v1/repos/:user/:repo/master_tokens/:id
     """
-    tokens = get_master_tokens(config, False)
+    tokens = _load_master_tokens(config)
+    matches = [token for token in tokens if token["name"] == config["token_name"]]
 
-    for token in tokens:
-        if token["name"] == config["token_name"]:
-            if config["debug"]:
-                print("Found token with name: {}".format(config["token_name"]))
-            try:
-                url = "{}{}".format(config["domain_base"], token["paths"]["self"])
-                resp = api_call(url, "delete", config["debug"])
-            except ValueError as ex:
-                abort("Unexpected response from packagecloud API: " "{}".format(str(ex)))
-            if resp.status_code == 204:
-                if verbose:
-                    print("Token destroyed, name: {}".format(config["token_name"]))
-                if config["debug"]:
-                    print("Result: {}" % resp)
-            else:
-                eprint("ERROR: Destroying token {} failed".format(config["token_name"]))
-                eprint("Result: {}".format(resp))
+    def destroy(token):
+        LOG.debug("Found token with name: %s", token["name"])
+        url = f"{config['domain_base']}{token['paths']['self']}"
+        return api_call(url, "delete")
+
+    for resp in run_concurrently(destroy, matches):
+        if resp.status_code == 204:
+            _invalidate_master_tokens(config)
+            if verbose:
+                print(f"Token destroyed, name: {config['token_name']}")
+            LOG.debug("Result: %s", resp)
+        else:
+            print(f"ERROR: Destroying token {config['token_name']} failed", file=sys.stderr)
+            print(f"Result: {resp}", file=sys.stderr)
 
     return True
 
@@ -194,77 +336,126 @@ def get_read_tokens(mastertoken, config):
         :master_token/read_tokens.json
     """
     mt_path = mastertoken["paths"]["self"]
-    url = "{}{}/read_tokens.json".format(config["domain_base"], mt_path)
+    url = f"{config['domain_base']}{mt_path}/read_tokens.json"
 
     try:
-        resp = api_call(url, "get", config["debug"])
-        tokens = resp.json()
+        resp = api_call(url, "get")
+        tokens = _json(resp)
     except ValueError as ex:
-        abort("Unexpected response from packagecloud API: " "{}".format(str(ex)))
+        abort(f"Unexpected response from packagecloud API: {ex}")
 
     return tokens["read_tokens"]
 
 
-def create_read_token(config, verbose):
+def create_read_token(config, verbose, mastertoken=None):
     """Create a named master token in repo
 
     https://packagecloud.io/docs/api#resource_read_tokens_method_create
 
     POST /api/v1/repos/:user/:repo/master_tokens/
          :master_token/read_tokens.json
+
+    mastertoken may be passed if the caller already holds it, which saves
+    looking it up by name.
     """
-    config["token_name"] = config["master_token_name"]
-    mastertoken = get_master_token(config, False)
     if mastertoken is None:
-        abort("No master token found for: {}.".format(config["master_token_name"]))
+        config["token_name"] = config["master_token_name"]
+        mastertoken = get_master_token(config, False)
+    if mastertoken is None:
+        abort(f"No master token found for: {config['master_token_name']}.")
 
     mt_path = mastertoken["paths"]["self"]
-    url = "{}{}/read_tokens.json".format(config["domain_base"], mt_path)
-    postdata = "read_token[name]={}".format(config["read_token_name"])
+    url = f"{config['domain_base']}{mt_path}/read_tokens.json"
+    postdata = urlencode({"read_token[name]": config["read_token_name"]}).encode("ascii")
 
     try:
-        resp = api_call(url, "post", config["debug"], data=postdata)
-        token = resp.json()
+        resp = api_call(url, "post", data=postdata, headers=FORM_HEADERS)
+        token = _json(resp)
     except ValueError as ex:
-        abort("Unexpected response from packagecloud API: " "{}".format(str(ex)))
+        abort(f"Unexpected response from packagecloud API: {ex}")
+    _invalidate_master_tokens(config)
 
     if verbose:
-        print("Read token {} with value {} created".format(token["name"], token["value"]), end="")
+        print(f"Read token {token['name']} with value {token['value']} created", end="")
     else:
-        print("{}".format(token["value"]), end="")
+        print(token["value"], end="")
     return token["value"]
 
 
-def destroy_read_token(config, verbose):
+def destroy_read_token(config, verbose, mastertoken=None):
     """Destroy a named master token in repo
 
     https://packagecloud.io/docs/api#resource_read_tokens_method_destroy
 
     DELETE /api/v1/repos/:user/:repo/master_tokens/:id
+
+    mastertoken may be passed if the caller already holds it, which saves
+    looking it up by name.
     """
-    config["token_name"] = config["master_token_name"]
-    mastertoken = get_master_token(config, False)
     if mastertoken is None:
-        abort("No master token found for: {}".format(config["master_token_name"]))
+        config["token_name"] = config["master_token_name"]
+        mastertoken = get_master_token(config, False)
+    if mastertoken is None:
+        abort(f"No master token found for: {config['master_token_name']}")
 
     mt_path = mastertoken["paths"]["self"]
-    tokens = get_read_tokens(mastertoken, config)
+    token = index_by_name(get_read_tokens(mastertoken, config)).get(config["read_token_name"])
+
+    if token is not None:
+        LOG.debug("Found token with name: %s", config["read_token_name"])
+        url = f"{config['domain_base']}{mt_path}/read_tokens/{token['id']}"
+        resp = api_call(url, "delete")
+        if resp.status_code == 204:
+            _invalidate_master_tokens(config)
+            if verbose:
+                print(f"Token destroyed, name: {config['read_token_name']}")
+            LOG.debug("Result: %s", resp)
+            return token["value"]
+        else:
+            print(f"ERROR: Destroying token {config['read_token_name']} failed", file=sys.stderr)
+            print(f"Result: {resp}", file=sys.stderr)
 
-    for token in tokens:
-        if token["name"] == config["read_token_name"]:
-            if config["debug"]:
-                print("Found token with name: {}".format(config["read_token_name"]))
-            try:
-                url = "{}{}/read_tokens/{}".format(config["domain_base"], mt_path, token["id"])
-                resp = api_call(url, "delete", config["debug"])
-            except ValueError as ex:
-                abort("Unexpected response from packagecloud API: " "{}".format(str(ex)))
-            if resp.status_code == 204:
-                if verbose:
-                    print("Token destroyed, name: {}".format(config["read_token_name"]))
-                if config["debug"]:
-                    print("Result: {}".format(resp))
-                return token["value"]
-            else:
-                eprint("ERROR: Destroying token {} failed".format(config["read_token_name"]))
-                eprint("Result: {}".format(resp))
+
+def destroy_read_tokens_matching(config, verbose, mastertoken=None):
+    """Destroy all read tokens whose name matches a shell-style pattern
+
+    https://packagecloud.io/docs/api#resource_read_tokens_method_destroy
+
+    DELETE /api/v1/repos/:user/:repo/master_tokens/
+           :master_token/read_tokens/:id
+
+    The DELETEs are issued concurrently.  Returns the values of the
+    destroyed tokens.
+    """
+    if mastertoken is None:
+        config["token_name"] = config["master_token_name"]
+        mastertoken = get_master_token(config, False)
+    if mastertoken is None:
+        abort(f"No master token found for: {config['master_token_name']}")
+
+    mt_path = mastertoken["paths"]["self"]
+    pattern = config["read_token_pattern"]
+    matches = [
+        token
+        for token in get_read_tokens(mastertoken, config)
+        if fnmatchcase(token["name"], pattern)
+    ]
+
+    def destroy(token):
+        LOG.debug("Found token with name: %s", token["name"])
+        url = f"{config['domain_base']}{mt_path}/read_tokens/{token['id']}"
+        return token, api_call(url, "delete")
+
+    destroyed = []
+    for token, resp in run_concurrently(destroy, matches):
+        if resp.status_code == 204:
+            _invalidate_master_tokens(config)
+            if verbose:
+                print(f"Token destroyed, name: {token['name']}")
+            LOG.debug("Result: %s", resp)
+            destroyed.append(token["value"])
+        else:
+            print(f"ERROR: Destroying token {token['name']} failed", file=sys.stderr)
+            print(f"Result: {resp}", file=sys.stderr)
+
+    return destroyed
@@ -15,61 +15,85 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import http.client
-
-import requests
-import semver
+import math
+import operator
+import re
 
 from st2common import log as logging
 from st2common.runners.base_action import Action
 
+from lib.packagecloud import SESSION
+from lib.packagecloud import TIMEOUT
+from lib.packagecloud import json_loads
+from lib.packagecloud import run_concurrently
+
 __all__ = ["ListPackagesAction"]
 
 LOG = logging.getLogger(__name__)
 
-BASE_URL = "https://%(api_token)s:@packagecloud.io/api/v1/repos/%(repo)s/packages.json"
+BASE_URL = "https://packagecloud.io/api/v1/repos/%(repo)s/packages.json"
+SEARCH_URL = "https://packagecloud.io/api/v1/repos/%(repo)s/search.json"
 MAX_PAGE_NUMBER = 100
+SORT_KEY = operator.itemgetter(0)
+SORT_REVERSE = {"descending": True, "ascending": False}
+VERSION_RE = re.compile(r"(\d+)(?:\.(\d+))?(?:\.(\d+))?")
 
 
-def format_semver(version, release):
+@functools.lru_cache(maxsize=4096)
+def meta_version_key(version, release):
     """
-    format_semver() removes "dev" from :version: and replaces it
-    with ".0".  This ensures semver's parse() function produces an object
-    that can be compared correctly with Python's sorted() function.
+    meta_version_key() returns a (major, minor, patch, release) tuple of
+    integers from the leading numbers of :version: and the :release:
+    number, which sorted() orders numerically field by field.
 
     The version field in Packagecloud's package metadata has an
     inconsistent format.  The two formats are shown below:
         "version": "3.9dev-8", "release": "8"
         "version": "3.9dev", "release": "8"
 
-    The trailing "-8" is also dropped when "dev" is removed.
+    Only the leading numbers are used, so the "dev" suffix and anything
+    after it are ignored and missing minor or patch numbers count as 0.
 
-    The :release: argument is appended to the resulting version string
-    in the form "+8" which semver parses as the build field.
+    Packages built for several distributions and architectures share the
+    same version and release, so keys are cached.
     """
-    if "dev" in version:
-        # Figure out what we should replace "dev" with
-        if version[version.index("dev") - 1] == ".":
-            suffix = "0-beta"
-        else:
-            suffix = ".0-beta"
+    major, minor, patch = VERSION_RE.match(version).groups(default="0")
+    return (int(major), int(minor), int(patch), int(release))
 
-        # Rewrite to contain only text before "dev" plus the new suffix
-        version = version[: version.index("dev")] + suffix
 
-    return f"{version}+{release}"
+def fetch_page(url, page, params, auth):
+    """
+    fetch_page() requests one page of package metadata over the pooled,
+    retrying packagecloud library session and returns the response headers
+    with the decoded page.  The body is decoded straight from its bytes in
+    the worker, and only decoded to text to raise an exception carrying it
+    if the request failed.
+    """
+    response = SESSION.get(url, params={**params, "page": page}, auth=auth, timeout=TIMEOUT)
 
+    if response.status_code != http.client.OK:  # pylint: disable=no-member
+        raise Exception(response.text)
 
-def meta_version_to_integer(version, release):
+    return response.headers, json_loads(response.content)
+
+
+def filter_packages(metadata, package, distro_version, version, release):
     """
-    Despite semver comparing major, minor, and patch numerically, the
-    release (aka semver.build) is treated as a string which causes incorrect
-    sorting.  A bit wise shift is used to calculate a single numerical
-    value for all four version attributes so sorted() performs the ordering
-    correctly. 8 bit shift for 256 major/minor/patch leaving 16bits for 65535 build.
+    filter_packages() yields the packages in :metadata: matching every
+    package property argument that is set.
     """
-    v = semver.Version.parse(format_semver(version, release))
-    return (v.major << 32) + (v.minor << 24) + (v.patch << 16) + int(v.build)
+    for pkg_info in metadata:
+        if package and pkg_info["name"] != package:
+            continue
+        if distro_version and pkg_info["distro_version"] != distro_version:
+            continue
+        if version and not pkg_info["version"].startswith(version):
+            continue
+        if release and pkg_info["release"] != release:
+            continue
+        yield pkg_info
 
 
 class ListPackagesAction(Action):
@@ -86,46 +110,51 @@ class ListPackagesAction(Action):
         sort_type="descending",
     ):
         params = {"per_page": per_page}
-        values = {"repo": repo, "api_token": api_token}
+        values = {"repo": repo}
+        auth = (api_token, "")
         url = BASE_URL % values
 
-        page = 1
-        metadata = []
-
-        while page < MAX_PAGE_NUMBER:
-            page_url = url + "?page=" + str(page)
-            response = requests.get(url=page_url, params=params)
-
-            if response.status_code != http.client.OK:  # pylint: disable=no-member
-                raise Exception(response.text)
-
-            metadata += response.json()
-
-            if len(metadata) >= int(response.headers.get("Total", 0)):
-                break
-
-            page += 1
-        LOG.debug("Processed %s page(s).", page)
-
-        # Filter package list based on package property arguments.
+        if package or distro_version:
+            # Have packagecloud search by name and distribution so only pages
+            # holding matching packages are fetched.  The search can match
+            # more than the exact name, so the filters below are still
+            # applied to its results.
+            url = SEARCH_URL % values
+            params["q"] = package or ""
+            if distro_version:
+                params["dist"] = distro_version
+
+        filters = (package, distro_version, version, release)
         packages = []
-        for pkg_info in metadata:
-            if package and pkg_info["name"] != package:
-                continue
-            if distro_version and pkg_info["distro_version"] != distro_version:
-                continue
-            if version and not pkg_info["version"].startswith(version):
-                continue
-            if release and pkg_info["release"] != release:
-                continue
-            packages.append(pkg_info)
+
+        # The first page tells how many packages there are, and so how many
+        # pages remain.  Those are then fetched concurrently.  Each page is
+        # filtered as it arrives so unwanted packages are never retained.
+        headers, metadata = fetch_page(url, 1, params, auth)
+        packages.extend(filter_packages(metadata, *filters))
+
+        total = int(headers.get("Total", 0))
+        page_size = int(headers.get("Per-Page", per_page)) or per_page
+        pages = min(max(math.ceil(total / page_size), 1), MAX_PAGE_NUMBER - 1)
+
+        # Total is only read once, from page 1, and exactly the remaining
+        # pages are requested; run_concurrently skips the thread pool when
+        # there is at most one of them.
+        results = run_concurrently(
+            lambda page: fetch_page(url, page, params, auth), range(2, pages + 1)
+        )
+        for _, metadata in results:
+            packages.extend(filter_packages(metadata, *filters))
+        LOG.debug("Processed %s page(s).", pages)
 
         if sort_packages:
-            reverse = sort_type == "descending"
-            return sorted(
-                packages,
-                key=lambda pkgmeta: (meta_version_to_integer(pkgmeta["version"], pkgmeta["release"])),
-                reverse=reverse,
-            )
+            # Compute each sort key once and sort on it alone, so packages
+            # themselves are never compared.
+            keyed = [
+                (meta_version_key(pkg_info["version"], pkg_info["release"]), pkg_info)
+                for pkg_info in packages
+            ]
+            keyed.sort(key=SORT_KEY, reverse=SORT_REVERSE.get(sort_type, False))
+            return [pkg_info for _, pkg_info in keyed]
 
         return packages